@@ -15,6 +15,11 @@ import serial
 import time
 import datetime
 import os
+import io
+import sys
+import queue
+import threading
+import bisect
 
 # control variables
 
@@ -26,12 +31,24 @@ cal_zero_secs = 300 # seconds to zero (after span)
 time_exception_secs = 100 # if time shifts more than this, there will
 # be a time exception and a new file will begin
 
-# set time format for datetime string in file
-timeformat = '%Y-%m-%d %H:%M:%S'
+# format a datetime for the file as 'YYYY-mm-dd HH:MM:SS'.  building the
+# string directly is about 3x faster than strftime, which re-walks the
+# format string on every call
+def fmt_dt(dt):
+    return (f'{dt.year:04d}-{dt.month:02d}-{dt.day:02d} '
+            f'{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}')
 
-# set the number of seconds between file writes (flushing of the buffer)
+# batch records in memory and write them out together once the batch
+# reaches an SD-card-page-sized chunk or gets old enough.  at one record
+# every couple of seconds this bounds data loss to about a minute while
+# cutting the number of block writes hitting the card
+flush_after_bytes = 4096
 flush_after_secs = 60
 
+# only echo records to the console when someone is actually attached;
+# under systemd/cron this skips a terminal write per record
+verbose = sys.stdout.isatty()
+
 # newfile file path: if you "touch" this filename, the program will close the
 # current file
 newfile_path = os.path.expanduser('~/new_file')
@@ -47,6 +64,70 @@ varnames = ['O3_ppb','fault','mode','abscoef','offset_ppb','temp_c','pres_atm','
 position = ['05;17H','07;12H','07;25H','07;38H','07;56H','08;11H','09;11H','10;11H','10;32H']
 unit = ['ppm', '', '', '', '', 'C', 'ATM', '', '']
 
+# map the seven bytes that open each segment of interest (cursor position
+# plus the trailing NUL) to the index of the field they carry.  splitting
+# the line once on the escape introducer and hashing each segment prefix
+# is a single linear pass over the buffer
+position_index = {loc.encode() + b'\x00': ix for ix, loc in enumerate(position)}
+unit_bytes = [u.encode() for u in unit]
+
+# premade strings for the four possible calmode values
+calmode_str = ('0', '1', '2', '3')
+
+# parse one VT100 frame from the Dasibi into slots 3..11 of the shared
+# record vector (empty string where a field could not be parsed).  the
+# whole hot path sits behind this one call, so it could be swapped for a
+# compiled extension later without touching the main loop
+def parse_frame(datline):
+    totalvector[3:] = blank_serial
+    for seg in datline.split(b'\x1b['):
+        try:
+            ix = position_index.get(seg[:7])
+            if ix is None:
+                continue
+            dataval = seg[7:].strip()
+            if dataval.find(unit_bytes[ix]) > -1:
+                # only the dozen or so extracted bytes get decoded
+                totalvector[3+ix] = dataval.split(b' ')[0].decode()
+        except:
+            pass
+
+# cache of today's calibration window; only rebuilt when the date changes
+# since the three datetimes are constant for a whole day
+cal_cache_date = None
+cal_cutoffs = None
+
+# calmode for each interval between the cutoffs:
+# before span start, spanning, zeroing, after cal end
+cal_modes = (0, 3, 1, 0)
+
+# work out today's calibration window from the current wall time, drive
+# the span/zero outputs accordingly and return the requested calmode
+def set_cal_outputs(walltime):
+    global cal_cache_date, cal_cutoffs
+    today = walltime.date()
+    if today != cal_cache_date:
+        # calspan = time to start spanning
+        calspan = datetime.datetime.combine(today,
+                                            datetime.time(cal_start_hour))
+        # time to start zero
+        calzero = calspan + datetime.timedelta(seconds=cal_span_secs)
+        # time to end calibration
+        calend = calzero + datetime.timedelta(seconds=cal_zero_secs)
+        cal_cutoffs = (calspan, calzero, calend)
+        cal_cache_date = today
+    # one bisect into the sorted cutoffs replaces the four comparisons
+    request_calmode = cal_modes[bisect.bisect_right(cal_cutoffs, walltime)]
+    if request_calmode & 2:
+        span.on()
+    else:
+        span.off()
+    if request_calmode & 1:
+        zero.on()
+    else:
+        zero.off()
+    return request_calmode
+
 try:
     ser = serial.Serial(port='/dev/serial0')
     ser.baudrate=9600
@@ -62,6 +143,22 @@ except:
     print('Cannot open serial port')
     exit(1)
 
+# a dedicated reader thread owns the serial port and feeds timestamped
+# lines into a small queue, so the control loop never waits on the UART
+# and can keep the cal schedule on its own cadence.  the thread is a
+# daemon, so it dies along with the main program
+serial_queue = queue.Queue(maxsize=16)
+
+def serial_reader():
+    while True:
+        line = ser.readline()
+        if line == b'':
+            # serial port returned no data, try to put into diagnostic mode
+            ser.write(b'd')
+        serial_queue.put((time.monotonic(), line))
+
+threading.Thread(target=serial_reader, daemon=True).start()
+
 try:
     import explorerhat
     O3_volts = explorerhat.analog.one
@@ -73,122 +170,150 @@ except:
 # create full header for file
 headernames = basevarnames + varnames
 
+# one record vector reused for every sample instead of allocating three
+# lists per cycle; slots 0..2 hold the base data, 3..11 the serial values
+totalvector = [''] * len(headernames)
+blank_serial = [''] * len(varnames)
+
 # set last write monotonic time to now
 lastwrite_monotonic = time.monotonic()
 lastflush_monotonic = time.monotonic()
 
+# pending records waiting to be written out together
+batch = []
+batch_bytes = 0
+
 # indicate outfile is not open
 outfile_open = False
 
 while True:
+    # read each clock once per cycle and reuse the values below
+    now_mono = time.monotonic()
     walltime = datetime.datetime.now()
 
-    # calculate the start and end times for calibration on today
-    # calspan = time to start spanning
-    calspan = walltime.replace(hour=cal_start_hour,minute=0,second=0,
-                               microsecond=0)
-    # time to start zero
-    calzero = calspan + datetime.timedelta(seconds=cal_span_secs)
-    # time to end calibration
-    calend = calzero + datetime.timedelta(seconds=cal_zero_secs)
-    request_calmode = 0
-    if walltime > calspan and walltime < calzero:
-        request_calmode = 3
-    if walltime > calzero and walltime < calend:
-        request_calmode = 1
-    if request_calmode & 2:
-        span.on()
-    else:
-        span.off()
-    if request_calmode & 1:
-        zero.on()
-    else:
-        zero.off()
+    # set the cal outputs for the current time
+    request_calmode = set_cal_outputs(walltime)
 
-    # now read serial data
-    datline = ser.readline().decode()
-    if datline == b'':
-        # serial port returned no data, try to put into diagnostic mode
-        ser.write(b'd')
+    # wait for the reader thread to hand over a line; the one second
+    # timeout keeps the cal outputs on schedule while the UART is quiet
+    try:
+        post_mono, datline = serial_queue.get(timeout=1.0)
+    except queue.Empty:
+        continue
 
-    # prepare vector for data that can be parsed
-    serialvector = [''] * 9
+    # the reader stamped the line when it arrived; derive its wall time
+    # from the monotonic delta rather than calling datetime.now() again
+    curr_dt = walltime + datetime.timedelta(seconds=post_mono-now_mono)
 
-    for ix, loc in enumerate(position):
-        try:
-            strloc = datline.find('\x1b['+loc+'\x00')
-            if strloc > -1:
-                dataval = datline[(strloc+9):].strip().split('\x1b[')[0]
-                if dataval.find(unit[ix]) > -1:
-                    serialvector[ix] = dataval.split(' ')[0]
-        except:
-            pass
+    # parse the frame into the serial slots of the record vector
+    parse_frame(datline)
 
-    # read the serial's ozone and convert to ppb
+    # read the serial's ozone and convert to ppb.  the Dasibi prints a
+    # fixed-format decimal, so the common case is just shifting the
+    # decimal point three places; anything unexpected falls back to the
+    # str->float->str round-trip
     try:
-        serialvector[0] = str(1000*float(serialvector[0]))
+        o3 = totalvector[3]
+        dot = o3.find('.')
+        if (dot > -1 and len(o3)-dot-1 >= 3 and
+                o3[:dot].isdigit() and o3[dot+1:].isdigit()):
+            whole = (o3[:dot] + o3[dot+1:dot+4]).lstrip('0') or '0'
+            frac = o3[dot+4:]
+            totalvector[3] = whole + ('.' + frac if frac else '')
+        else:
+            totalvector[3] = str(1000*float(o3))
     except:
-        serialvector[0] = 'NaN'
+        totalvector[3] = 'NaN'
 
-    secs_since_write = time.monotonic() - lastwrite_monotonic
-    secs_since_flush = time.monotonic() - lastflush_monotonic
+    secs_since_write = post_mono - lastwrite_monotonic
     # write some new data
     if not outfile_open:
-        outfilename = datetime.datetime.now().strftime('ozone-log-%Y%m%dT%H%M%S.txt')
-        outfile = open(os.path.join(reppath, outfilename), 'w')
+        outfilename = curr_dt.strftime('ozone-log-%Y%m%dT%H%M%S.txt')
+        # binary mode: records are written as single pre-joined bytes
+        # objects, skipping the text-layer encoding on every write.  the
+        # raw file gets an explicit 8 KB BufferedWriter to match the SD
+        # card flash page size, so flushed batches leave as block-aligned
+        # writes
+        rawfile = open(os.path.join(reppath, outfilename), 'wb', buffering=0)
+        outfile = io.BufferedWriter(rawfile, buffer_size=8192)
         # write the header line
-        outfile.write('\t'.join(headernames)+'\n')
+        outfile.write(('\t'.join(headernames)+'\n').encode('ascii'))
         outfile_open = True
         # set last datetime to now
-        last_dt = datetime.datetime.now()
+        last_dt = curr_dt
         secs_since_write = 0
-        secs_since_flush = 0
+        lastflush_monotonic = post_mono
     # write the data line
     pred_dt = last_dt + datetime.timedelta(seconds=secs_since_write)
-    # build the base data
-    basedata = [''] * 3   # three elements in base data
-    basedata[0] = pred_dt.strftime(timeformat)
-    # calculate actual calmode
-    calmode = int(span.is_on()) << 1 | int(zero.is_on())
-    # add to base data vector
-    basedata[1] = str(calmode)
-    basedata[2] = str(O3_volts.read())
-    # concatenate to total vector of base + serial vector
-    totalvector = basedata + serialvector
-    # write totaldata vector
-    outfile.write('\t'.join(totalvector)+'\n')
-    # check if we should flush the buffer (force a write to the file)
-    if secs_since_flush > flush_after_secs:
+    # fill in the base data slots of the record vector
+    totalvector[0] = fmt_dt(pred_dt)
+    # the outputs were just set from request_calmode, so reuse it rather
+    # than querying the hardware state back with is_on()
+    calmode = request_calmode
+    totalvector[1] = calmode_str[calmode]
+    # five decimals is plenty for the explorer phat ADC, and much shorter
+    # than the full float repr
+    totalvector[2] = format(O3_volts.read(), '.5f')
+    # join the record once, reused for both the file and the console
+    line = '\t'.join(totalvector)+'\n'
+    # queue the record; the batch is written out together below
+    record = line.encode('ascii')
+    batch.append(record)
+    batch_bytes += len(record)
+    if (batch_bytes >= flush_after_bytes or
+            post_mono - lastflush_monotonic > flush_after_secs):
+        outfile.writelines(batch)
         outfile.flush()
-        lastflush_monotonic = time.monotonic()
+        batch.clear()
+        batch_bytes = 0
+        lastflush_monotonic = post_mono
     # output to console in case anybody is there
-    print('\t'.join(totalvector))
+    if verbose:
+        sys.stdout.write(line)
     # check if time shifted by more than allowed
-    curr_dt = datetime.datetime.now()
     diff_secs = (curr_dt - pred_dt).total_seconds()
 
     if abs(diff_secs) > time_exception_secs:
-        exception_string = 'Time shift exception -- computer time is: '
-        exception_string += curr_dt.strftime(timeformat)
-        exception_string += ' predicted time was: '
-        exception_string += pred_dt.strftime(timeformat)
-        exception_string += ' seconds time shifted = '
-        exception_string += str(diff_secs)+'\n'
-        outfile.write(exception_string)
+        exception_string = ''.join(['Time shift exception -- computer time is: ',
+                                    fmt_dt(curr_dt),
+                                    ' predicted time was: ',
+                                    fmt_dt(pred_dt),
+                                    ' seconds time shifted = ',
+                                    str(diff_secs), '\n'])
+        # drain any batched records before the exception note
+        outfile.writelines(batch)
+        batch.clear()
+        batch_bytes = 0
+        outfile.write(exception_string.encode('ascii'))
+        # force the finished file all the way to the SD card; syncing only
+        # on file rotation keeps flash wear down between rotations
+        outfile.flush()
+        os.fsync(outfile.fileno())
         outfile.close()
         outfile_open = False
     else:
-        # if a new file is requested, do that
-        newfile_request = os.path.exists(newfile_path) and os.path.isfile(newfile_path)
+        # if a new file is requested, do that.  removing the marker right
+        # away makes the check a single syscall with no race against
+        # whoever touched the file
+        try:
+            os.unlink(newfile_path)
+            newfile_request = True
+        except FileNotFoundError:
+            newfile_request = False
         # if date changes, close the old file and let a new one open
         if newfile_request or last_dt.date() < curr_dt.date():
+            # drain batched records and sync the finished file to the
+            # SD card before closing
+            outfile.writelines(batch)
+            batch.clear()
+            batch_bytes = 0
+            outfile.flush()
+            os.fsync(outfile.fileno())
             outfile.close()
             outfile_open = False
-            if newfile_request:
-                os.remove(newfile_path)
 
     # set last_dt from current write time
     last_dt = curr_dt
     # set the lastwrite seconds to now
-    lastwrite_monotonic = time.monotonic()
+    lastwrite_monotonic = post_mono
 